@@ -1,11 +1,15 @@
 
 import asyncio
+import hashlib
+import hmac
 import os
 import re
-import random
+import secrets
 import string
-from datetime import datetime, timezone
+import time
+from contextlib import asynccontextmanager
 from dataclasses import dataclass
+from typing import AsyncIterator, Awaitable, Callable, TypeVar
 
 import aiosqlite
 from aiogram import Bot, Dispatcher, F
@@ -25,19 +29,31 @@ from dotenv import load_dotenv
 
 load_dotenv()
 BOT_TOKEN = os.getenv("BOT_TOKEN")
-ADMIN_IDS = set(map(int, filter(None, (os.getenv("ADMIN_IDS") or "").split(","))))
+ADMIN_IDS: frozenset[int] = frozenset(int(x) for x in (os.getenv("ADMIN_IDS") or "").split(",") if x)
 REQUIRED_CHANNEL = os.getenv("REQUIRED_CHANNEL")  # like @mychannel (public) or ID for private
-LOG_GROUP_ID = int(os.getenv("LOG_GROUP_ID" or "0"))
+LOG_GROUP_ID = int(os.getenv("LOG_GROUP_ID") or "0")
 
 if not BOT_TOKEN:
     raise SystemExit("BOT_TOKEN missing in .env")
 
 bot = Bot(BOT_TOKEN, parse_mode="HTML")
 dp = Dispatcher()
+# Filled in on_startup(); constant for the lifetime of the process
+BOT_USERNAME: str = ""
 
 # --------------- Utilities ---------------
 TICKET_LEN = 6
+# Telegram caps a message at 4096 chars, so only the latest tickets are listed
+TICKETS_SHOWN = 50
 ALPHABET = string.ascii_uppercase + string.digits
+UPI_RE = re.compile(r"^[\w._-]+@[\w.-]+$")
+
+
+def fmt_inr(cents: int) -> str:
+    # integer paise -> "₹R.PP" without going through a float
+    sign = "-" if cents < 0 else ""
+    r, p = divmod(abs(cents), 100)
+    return f"{sign}₹{r}.{p:02d}"
 
 FIRST_MESSAGE_DEFAULT = (
     "<b>🎟️ Welcome to Free Lottery Bot!</b>\n\n"
@@ -48,6 +64,9 @@ FIRST_MESSAGE_DEFAULT = (
     "Join our channel: {channel}\n"
     "Then tap <b>Verify</b> below to complete device check & claim your ticket."
 )
+NO_WELCOME_TEXT = (
+    "No welcome ticket granted (already claimed or same device detected). You can still refer and earn."
+)
 
 @dataclass
 class Settings:
@@ -121,35 +140,48 @@ class AdminFSM(StatesGroup):
 # --------------- DB ---------------
 DB_PATH = "lottery.db"
 
+# Applied to every live connection right after it is opened (the writer also
+# switches the database to WAL first; read-only connections cannot).
+PRAGMA_SQL = """
+PRAGMA busy_timeout=5000;
+PRAGMA synchronous=NORMAL;
+PRAGMA cache_size=-20000;
+PRAGMA temp_store=memory;
+PRAGMA foreign_keys=ON;
+"""
+
 INIT_SQL = """
-PRAGMA journal_mode=WAL;
 CREATE TABLE IF NOT EXISTS users (
   user_id INTEGER PRIMARY KEY,
-  joined_at TEXT,
+  joined_at INTEGER,
   ref_by INTEGER,
   upi TEXT UNIQUE,
   balance_cents INTEGER DEFAULT 0,
   total_won_cents INTEGER DEFAULT 0,
   last_win_round INTEGER,
   device_hash TEXT,
-  welcomes_given INTEGER DEFAULT 0 -- 0 not given, 1 given
+  welcomes_given INTEGER DEFAULT 0, -- 0 not given, 1 given
+  valid_referral_count INTEGER DEFAULT 0 -- kept in step with referrals.valid by try_award_referral
 );
+-- partial index matching the earnings leaderboard predicate
+CREATE INDEX IF NOT EXISTS idx_users_total_won ON users(total_won_cents DESC) WHERE total_won_cents > 0;
 
 CREATE TABLE IF NOT EXISTS tickets (
   id INTEGER PRIMARY KEY AUTOINCREMENT,
   user_id INTEGER,
-  code TEXT UNIQUE,
   round INTEGER,
-  created_at TEXT
+  created_at INTEGER
 );
+CREATE INDEX IF NOT EXISTS idx_tickets_user ON tickets(user_id, id DESC);
 
 CREATE TABLE IF NOT EXISTS referrals (
   id INTEGER PRIMARY KEY AUTOINCREMENT,
   referrer INTEGER,
   referee INTEGER,
-  created_at TEXT,
+  created_at INTEGER,
   valid INTEGER DEFAULT 0 -- set to 1 when referee successfully gets welcome ticket
 );
+CREATE INDEX IF NOT EXISTS idx_referrals_referrer ON referrals(referrer, valid);
 
 CREATE TABLE IF NOT EXISTS settings (
   key TEXT PRIMARY KEY,
@@ -161,18 +193,205 @@ CREATE TABLE IF NOT EXISTS withdrawals (
   user_id INTEGER,
   amount_cents INTEGER,
   upi TEXT,
-  created_at TEXT,
+  created_at INTEGER,
   status TEXT DEFAULT 'pending'
 );
 """
 
-async def db()
-:
-    return await aiosqlite.connect(DB_PATH)
+# Indexes on columns that older databases only get from a migration, so these
+# are created after the migrations in ensure_db() have run.
+INDEX_SQL = """
+CREATE INDEX IF NOT EXISTS idx_users_referrals ON users(valid_referral_count DESC) WHERE valid_referral_count > 0;
+"""
+
+T = TypeVar("T")
+WriteOp = Callable[[aiosqlite.Connection], Awaitable[T]]
+
+# submit()ted writes are committed together: up to this many per transaction,
+# collected for at most this many seconds after the first one arrives.
+WRITE_BATCH_MAX = 100
+WRITE_BATCH_WINDOW = 0.01
+
+
+def _fail_pending(futs: list[asyncio.Future], exc: BaseException):
+    for fut in futs:
+        if not fut.done():
+            fut.set_exception(exc)
+
+
+class SqlitePool:
+    """A single writer connection plus a queue of read-only connections.
+
+    Under WAL, readers never block the writer, so read-only handlers take a
+    connection from the reader queue while writes are serialized on the one
+    writer connection. Hot-path writes go through submit(), which lets a
+    background task group them into one transaction (and one fsync) per batch.
+    """
+
+    def __init__(self, path: str, readers: int):
+        self.path = path
+        self.size = readers
+        self.writer: aiosqlite.Connection | None = None
+        self._write_lock = asyncio.Lock()
+        self._readers: asyncio.Queue[aiosqlite.Connection] = asyncio.Queue()
+        self._write_q: asyncio.Queue[tuple[WriteOp, asyncio.Future]] = asyncio.Queue()
+        self._writer_task: asyncio.Task | None = None
+
+    async def open(self):
+        # Autocommit mode: write paths issue their own BEGIN IMMEDIATE via transaction().
+        self.writer = await aiosqlite.connect(self.path, isolation_level=None)
+        await self.writer.execute("PRAGMA journal_mode=WAL")
+        await self.writer.executescript(PRAGMA_SQL)
+        for _ in range(self.size):
+            con = await aiosqlite.connect(f"file:{self.path}?mode=ro", uri=True)
+            await con.executescript(PRAGMA_SQL)
+            self._readers.put_nowait(con)
+        self._writer_task = asyncio.create_task(self._writer_loop())
+
+    async def close(self):
+        if self._writer_task is not None:
+            self._writer_task.cancel()
+            # wait() rather than await: the task may already have died with an error
+            await asyncio.wait([self._writer_task])
+            self._writer_task = None
+        # nothing will run what is still queued; fail it instead of leaving callers waiting
+        closed = RuntimeError("database pool is closed")
+        while not self._write_q.empty():
+            _, fut = self._write_q.get_nowait()
+            _fail_pending([fut], closed)
+        while not self._readers.empty():
+            await self._readers.get_nowait().close()
+        if self.writer is not None:
+            await self.writer.close()
+            self.writer = None
+
+    @asynccontextmanager
+    async def read(self) -> AsyncIterator[aiosqlite.Connection]:
+        con = await self._readers.get()
+        try:
+            yield con
+        finally:
+            self._readers.put_nowait(con)
+
+    @asynccontextmanager
+    async def write(self) -> AsyncIterator[aiosqlite.Connection]:
+        async with self._write_lock:
+            yield self.writer
+
+    async def submit(self, op: "WriteOp[T]") -> T:
+        # Runs op(con) in the writer's next batch; resolves once the batch is committed
+        if self._writer_task is None or self._writer_task.done():
+            raise RuntimeError("database writer is not running")
+        fut = asyncio.get_running_loop().create_future()
+        self._write_q.put_nowait((op, fut))
+        return await fut
+
+    async def _writer_loop(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            batch = [await self._write_q.get()]
+            try:
+                deadline = loop.time() + WRITE_BATCH_WINDOW
+                while len(batch) < WRITE_BATCH_MAX:
+                    try:
+                        batch.append(await asyncio.wait_for(self._write_q.get(), deadline - loop.time()))
+                    except asyncio.TimeoutError:
+                        break
+                await self._run_batch(batch)
+            except Exception as e:
+                # e.g. a failed rollback; keep the writer alive for the next batch
+                _fail_pending([fut for _, fut in batch], e)
+            except BaseException:
+                _fail_pending([fut for _, fut in batch], RuntimeError("database writer stopped"))
+                raise
+
+    async def _run_batch(self, batch: list[tuple["WriteOp", asyncio.Future]]):
+        results = []
+        async with self.write() as con:
+            try:
+                await con.execute("BEGIN IMMEDIATE")
+                for op, _ in batch:
+                    # a failing op only rolls back its own statements, not the batch
+                    await con.execute("SAVEPOINT op")
+                    try:
+                        results.append((await op(con), None))
+                    except Exception as e:
+                        await con.execute("ROLLBACK TO op")
+                        results.append((None, e))
+                    await con.execute("RELEASE op")
+                await con.commit()
+            except BaseException as e:
+                if con.in_transaction:
+                    await con.rollback()
+                if not isinstance(e, Exception):
+                    raise
+                results = [(None, e)] * len(batch)
+        for (_, fut), (result, exc) in zip(batch, results):
+            if fut.done():
+                continue
+            if exc is not None:
+                fut.set_exception(exc)
+            else:
+                fut.set_result(result)
+
+
+POOL = SqlitePool(DB_PATH, readers=os.cpu_count() or 4)
+
+
+@asynccontextmanager
+async def transaction(con: aiosqlite.Connection) -> AsyncIterator[aiosqlite.Connection]:
+    """Run the enclosed statements as one BEGIN IMMEDIATE ... COMMIT unit.
+
+    Taking the write lock up front avoids SQLITE_BUSY upgrades when a
+    deferred transaction turns from reader into writer under WAL.
+    """
+    await con.execute("BEGIN IMMEDIATE")
+    try:
+        yield con
+    except BaseException:
+        await con.rollback()
+        raise
+    await con.commit()
+
+# Timestamp columns that older databases created as ISO-8601 TEXT; they now
+# hold Unix epoch seconds as INTEGER.
+EPOCH_COLUMNS = (
+    ("users", "joined_at"),
+    ("tickets", "created_at"),
+    ("referrals", "created_at"),
+    ("withdrawals", "created_at"),
+)
+
+async def migrate_epoch_columns(con):
+    for table, col in EPOCH_COLUMNS:
+        cur = await con.execute(f"PRAGMA table_info({table})")
+        types = {name: type_ for _, name, type_, *_ in await cur.fetchall()}
+        if types.get(col) != "TEXT":
+            continue
+        # SQLite can't change a column's type in place: copy into a new column and swap
+        await con.execute(f"ALTER TABLE {table} ADD COLUMN {col}_epoch INTEGER")
+        await con.execute(f"UPDATE {table} SET {col}_epoch = CAST(strftime('%s', {col}) AS INTEGER)")
+        await con.execute(f"ALTER TABLE {table} DROP COLUMN {col}")
+        await con.execute(f"ALTER TABLE {table} RENAME COLUMN {col}_epoch TO {col}")
+
+async def migrate_referral_counts(con):
+    cur = await con.execute("SELECT 1 FROM pragma_table_info('users') WHERE name='valid_referral_count'")
+    if await cur.fetchone():
+        return
+    await con.execute("ALTER TABLE users ADD COLUMN valid_referral_count INTEGER DEFAULT 0")
+    await con.execute(
+        "UPDATE users SET valid_referral_count = "
+        "(SELECT COUNT(1) FROM referrals WHERE referrer=users.user_id AND valid=1)"
+    )
 
 async def ensure_db():
-    async with aiosqlite.connect(DB_PATH) as con:
+    global TICKET_SECRET, LEGACY_TICKET_CODES
+    async with POOL.write() as con:
         await con.executescript(INIT_SQL)
+        async with transaction(con):
+            await migrate_epoch_columns(con)
+            await migrate_referral_counts(con)
+        await con.executescript(INDEX_SQL)
         # default settings
         cur = await con.execute("SELECT value FROM settings WHERE key='draw_time'")
         row = await cur.fetchone()
@@ -189,46 +408,116 @@ async def ensure_db():
         if not row:
             await con.execute("INSERT OR REPLACE INTO settings(key,value) VALUES('first_message', ?)",
                               (FIRST_MESSAGE_DEFAULT,))
+        # ticket-code key: generated once, never changes afterwards
+        cur = await con.execute("SELECT value FROM settings WHERE key='ticket_secret'")
+        row = await cur.fetchone()
+        if not row:
+            row = (secrets.token_hex(32),)
+            await con.execute("INSERT INTO settings(key,value) VALUES('ticket_secret', ?)", row)
+        TICKET_SECRET = bytes.fromhex(row[0])
+        cur = await con.execute("SELECT 1 FROM pragma_table_info('tickets') WHERE name='code'")
+        LEGACY_TICKET_CODES = await cur.fetchone() is not None
         await con.commit()
 
+# Settings only change through set_setting(), so keep the last read in memory.
+# set_setting() bumps the generation; a read that overlapped a change sees a
+# different generation when it finishes and does not store its (stale) result.
+_SETTINGS_CACHE: Settings | None = None
+_SETTINGS_GEN = 0
+
 async def get_settings() -> Settings:
-    async with aiosqlite.connect(DB_PATH) as con:
-        m = {}
+    global _SETTINGS_CACHE
+    if _SETTINGS_CACHE is not None:
+        return _SETTINGS_CACHE
+    gen = _SETTINGS_GEN
+    m = {}
+    async with POOL.read() as con:
         async with con.execute("SELECT key, value FROM settings") as cur:
             async for k, v in cur:
                 m[k] = v
-        return Settings(
-            draw_time=m.get('draw_time', 'Every day at 8:00 PM'),
-            reward_amount=int(m.get('reward_amount', '5000')),
-            first_message=m.get('first_message', FIRST_MESSAGE_DEFAULT),
-        )
+    settings = Settings(
+        draw_time=m.get('draw_time', 'Every day at 8:00 PM'),
+        reward_amount=int(m.get('reward_amount', '5000')),
+        first_message=m.get('first_message', FIRST_MESSAGE_DEFAULT),
+    )
+    if gen == _SETTINGS_GEN:
+        _SETTINGS_CACHE = settings
+    return settings
 
 async def set_setting(key: str, value: str):
-    async with aiosqlite.connect(DB_PATH) as con:
+    global _SETTINGS_CACHE, _SETTINGS_GEN
+    async with POOL.write() as con:
         await con.execute("INSERT OR REPLACE INTO settings(key,value) VALUES(?,?)", (key, value))
         await con.commit()
+        _SETTINGS_GEN += 1
+        _SETTINGS_CACHE = None
 
 # --------------- Core helpers ---------------
 
-def gen_ticket_code() -> str:
-    return ''.join(random.choices(ALPHABET, k=TICKET_LEN))
-
-async def unique_ticket(con) -> str:
+# Round new tickets are issued into; loaded once in on_startup() instead of
+# running MAX(round) on every award.
+CURRENT_ROUND: int = 1
+
+async def load_current_round():
+    global CURRENT_ROUND
+    async with POOL.read() as con:
+        cur = await con.execute("SELECT COALESCE(MAX(round), 0) FROM tickets")
+        (max_round,) = await cur.fetchone()
+    # Use current max round as round id; 1 if there are no tickets yet
+    CURRENT_ROUND = max_round if max_round > 0 else 1
+
+# New ticket codes are not stored: they are derived from tickets.id with a keyed
+# 4-round Feistel permutation over 30-bit ids, written as TICKET_LEN base-36
+# digits (36**6 > 2**30), so they look random but are unique by construction.
+# Databases created before that keep their stored tickets.code values.
+TICKET_HALF_BITS = 15
+TICKET_HALF_MASK = (1 << TICKET_HALF_BITS) - 1
+TICKET_ROUNDS = 4
+# Both loaded by ensure_db(): the permutation key (generated once and kept in
+# settings) and whether tickets still has the legacy code column.
+TICKET_SECRET: bytes = b""
+LEGACY_TICKET_CODES = False
+
+def _ticket_round(i: int, half: int) -> int:
+    digest = hmac.new(TICKET_SECRET, bytes((i,)) + half.to_bytes(2, "big"), hashlib.sha256).digest()
+    return int.from_bytes(digest[:2], "big") & TICKET_HALF_MASK
+
+def encode_ticket(ticket_id: int) -> str:
+    if not 0 <= ticket_id < 1 << (2 * TICKET_HALF_BITS):
+        raise ValueError(f"ticket id out of range: {ticket_id}")
+    left, right = ticket_id >> TICKET_HALF_BITS, ticket_id & TICKET_HALF_MASK
+    for i in range(TICKET_ROUNDS):
+        left, right = right, left ^ _ticket_round(i, right)
+    n = (left << TICKET_HALF_BITS) | right
+    chars = []
+    for _ in range(TICKET_LEN):
+        n, d = divmod(n, len(ALPHABET))
+        chars.append(ALPHABET[d])
+    return ''.join(reversed(chars))
+
+async def insert_ticket(con, user_id: int) -> str:
     while True:
-        code = gen_ticket_code()
+        cur = await con.execute(
+            "INSERT INTO tickets(user_id, round, created_at) VALUES(?,?,?)",
+            (user_id, CURRENT_ROUND, int(time.time())),
+        )
+        ticket_id = cur.lastrowid
+        code = encode_ticket(ticket_id)
+        if not LEGACY_TICKET_CODES:
+            return code
+        # skip ids whose derived code matches a stored legacy code (UNIQUE-indexed lookup)
         cur = await con.execute("SELECT 1 FROM tickets WHERE code=?", (code,))
         if not await cur.fetchone():
             return code
+        await con.execute("DELETE FROM tickets WHERE id=?", (ticket_id,))
 
-async def get_or_create_user(con, user_id: int, ref_by: int | None = None):
-    cur = await con.execute("SELECT user_id FROM users WHERE user_id=?", (user_id,))
-    row = await cur.fetchone()
-    if row:
-        return
-    await con.execute(
-        "INSERT INTO users(user_id, joined_at, ref_by) VALUES(?,?,?)",
-        (user_id, datetime.now(timezone.utc).isoformat(), ref_by),
+async def get_or_create_user(con, user_id: int, ref_by: int | None, joined_at: int) -> bool:
+    # returns True if the user row was created by this call
+    cur = await con.execute(
+        "INSERT OR IGNORE INTO users(user_id, joined_at, ref_by) VALUES(?,?,?)",
+        (user_id, joined_at, ref_by),
     )
+    return cur.rowcount == 1
 
 async def is_in_channel(user_id: int) -> bool:
     try:
@@ -242,7 +531,10 @@ async def same_device_detected(user_id: int) -> bool:
     # TODO: Replace with real device-fingerprint logic
     return False
 
-async def award_welcome_ticket(con, user_id: int) -> bool:
+# The award helpers run inside the caller's write transaction. Device checks
+# may call out to an external service, so the caller runs them beforehand and
+# passes in only the results.
+async def award_welcome_ticket(con, user_id: int, same_device: bool) -> bool:
     # returns True if ticket awarded
     cur = await con.execute("SELECT welcomes_given FROM users WHERE user_id=?", (user_id,))
     row = await cur.fetchone()
@@ -250,53 +542,38 @@ async def award_welcome_ticket(con, user_id: int) -> bool:
         return False
     if row[0] == 1:
         return False
-    if await same_device_detected(user_id):
+    if same_device:
         # mark as considered to prevent repeated attempts
         await con.execute("UPDATE users SET welcomes_given=0 WHERE user_id=?", (user_id,))
-        await con.commit()
         return False
-    code = await unique_ticket(con)
-    # Use current max round as round id; store 1 if empty
-    cur2 = await con.execute("SELECT COALESCE(MAX(round), 0) FROM tickets")
-    (max_round,) = await cur2.fetchone()
-    current_round = max_round if max_round > 0 else 1
-    await con.execute(
-        "INSERT INTO tickets(user_id, code, round, created_at) VALUES(?,?,?,?)",
-        (user_id, code, current_round, datetime.now(timezone.utc).isoformat()),
-    )
+    await insert_ticket(con, user_id)
     await con.execute("UPDATE users SET welcomes_given=1 WHERE user_id=?", (user_id,))
-    await con.commit()
     return True
 
-async def try_award_referral(con, referee_id: int):
-    # When referee got welcome ticket, credit referrer if eligible
+async def try_award_referral(con, referee_id: int, same_device: bool):
+    # When referee got welcome ticket, credit referrer if eligible.
+    # same_device: device check hit on either the referee or the referrer (policy: abort)
+    if same_device:
+        return
     cur = await con.execute("SELECT ref_by FROM users WHERE user_id=?", (referee_id,))
     row = await cur.fetchone()
     if not row or row[0] is None:
         return
     referrer = row[0]
-    # device check across both accounts: if same device, abort (policy)
-    if await same_device_detected(referee_id) or await same_device_detected(referrer):
-        return
     # mark referral valid & award 1 ticket to referrer
-    await con.execute(
-        "UPDATE referrals SET valid=1 WHERE referee=? AND referrer=?",
+    cur = await con.execute(
+        "UPDATE referrals SET valid=1 WHERE referee=? AND referrer=? AND valid=0",
         (referee_id, referrer),
     )
-    code = await unique_ticket(con)
-    cur2 = await con.execute("SELECT COALESCE(MAX(round), 0) FROM tickets")
-    (max_round,) = await cur2.fetchone()
-    current_round = max_round if max_round > 0 else 1
     await con.execute(
-        "INSERT INTO tickets(user_id, code, round, created_at) VALUES(?,?,?,?)",
-        (referrer, code, current_round, datetime.now(timezone.utc).isoformat()),
+        "UPDATE users SET valid_referral_count = valid_referral_count + ? WHERE user_id=?",
+        (cur.rowcount, referrer),
     )
-    await con.commit()
+    await insert_ticket(con, referrer)
 
 # --------------- Handlers ---------------
 @dp.message(CommandStart())
 async def start(m: Message, state: FSMContext):
-    await ensure_db()
     args = (m.text or "").split(maxsplit=1)
     ref_by = None
     if len(args) == 2 and args[1].startswith("ref_"):
@@ -304,14 +581,18 @@ async def start(m: Message, state: FSMContext):
             ref_by = int(args[1][4:])
         except ValueError:
             ref_by = None
-    async with aiosqlite.connect(DB_PATH) as con:
-        await get_or_create_user(con, m.from_user.id, ref_by)
-        if ref_by and ref_by != m.from_user.id:
+    now = int(time.time())
+
+    async def register(con):
+        created = await get_or_create_user(con, m.from_user.id, ref_by, now)
+        # ref_by is only recorded for new users, so only they get a referral row
+        if created and ref_by and ref_by != m.from_user.id:
             await con.execute(
                 "INSERT INTO referrals(referrer, referee, created_at) VALUES(?,?,?)",
-                (ref_by, m.from_user.id, datetime.now(timezone.utc).isoformat()),
+                (ref_by, m.from_user.id, now),
             )
-            await con.commit()
+
+    await POOL.submit(register)
     settings = await get_settings()
     text = settings.first_message.format(
         draw_time=settings.draw_time, reward=settings.reward_amount, channel=REQUIRED_CHANNEL
@@ -326,46 +607,72 @@ async def start(m: Message, state: FSMContext):
 @dp.callback_query(F.data == "verify")
 async def verify_join_and_device(cq: CallbackQuery):
     user_id = cq.from_user.id
-    if not await is_in_channel(user_id):
+    # ref_by is fixed when the user row is created, so a reader can fetch it;
+    # grant() re-checks welcomes_given inside the write transaction
+    async with POOL.read() as con:
+        cur = await con.execute("SELECT welcomes_given, ref_by FROM users WHERE user_id=?", (user_id,))
+        row = await cur.fetchone()
+    if not row or row[0] == 1:
+        await cq.message.answer(NO_WELCOME_TEXT, reply_markup=MENU)
+        await cq.answer()
+        return
+    referrer = row[1]
+    # network-bound checks run concurrently and outside the write transaction
+    checks = [is_in_channel(user_id), same_device_detected(user_id)]
+    if referrer is not None:
+        checks.append(same_device_detected(referrer))
+    joined, same_device, *referrer_check = await asyncio.gather(*checks)
+    referrer_same_device = any(referrer_check)
+    if not joined:
         await cq.answer("Please join the channel first.", show_alert=True)
         return
-    async with aiosqlite.connect(DB_PATH) as con:
-        awarded = await award_welcome_ticket(con, user_id)
-        if awarded:
 
-await try_award_referral(con, user_id)
-            await cq.message.answer("🎉 Welcome ticket granted!", reply_markup=MENU)
-        else:
-            await cq.message.answer(
-                "No welcome ticket granted (already claimed or same device detected). You can still refer and earn.",
-                reply_markup=MENU,
-            )
+    async def grant(con) -> bool:
+        awarded = await award_welcome_ticket(con, user_id, same_device)
+        if awarded:
+            await try_award_referral(con, user_id, same_device or referrer_same_device)
+        return awarded
+
+    awarded = await POOL.submit(grant)
+    if awarded:
+        await cq.message.answer("🎉 Welcome ticket granted!", reply_markup=MENU)
+    else:
+        await cq.message.answer(NO_WELCOME_TEXT, reply_markup=MENU)
     await cq.answer()
 
 
 # -------- User menu commands --------
 @dp.message(F.text == "🎟️ My Tickets")
 async def my_tickets(m: Message):
-    async with aiosqlite.connect(DB_PATH) as con:
+    async with POOL.read() as con:
+        # tickets issued before codes were derived keep showing their stored code
+        code_col = "code" if LEGACY_TICKET_CODES else "NULL"
         cur = await con.execute(
-            "SELECT code FROM tickets WHERE user_id=? ORDER BY id DESC", (m.from_user.id,)
+            f"SELECT id, {code_col} FROM tickets WHERE user_id=? ORDER BY id DESC LIMIT ?",
+            (m.from_user.id, TICKETS_SHOWN),
         )
         rows = await cur.fetchall()
-        settings = await get_settings()
+        total = len(rows)
+        if total == TICKETS_SHOWN:
+            # only a full page can have more behind it; idx_tickets_user covers the count
+            cur = await con.execute("SELECT COUNT(1) FROM tickets WHERE user_id=?", (m.from_user.id,))
+            (total,) = await cur.fetchone()
+    settings = await get_settings()
     if not rows:
         await m.answer(
             f"You have no tickets yet. Next draw: {settings.draw_time}. Invite friends to earn tickets!"
         )
         return
-    codes = "\n".join([f"<code>{r[0]}</code>" for r in rows])
+    codes = "\n".join([f"<code>{code or encode_ticket(ticket_id)}</code>" for ticket_id, code in rows])
+    shown = f"showing latest {len(rows)} of {total}\n" if total > len(rows) else ""
     await m.answer(
-        f"<b>Your Tickets</b> (total: {len(rows)})\nNext draw: {settings.draw_time}\n\n{codes}"
+        f"<b>Your Tickets</b> (total: {total})\nNext draw: {settings.draw_time}\n{shown}\n{codes}"
     )
 
 @dp.message(F.text == "👥 Refer")
 async def refer(m: Message):
-    link = f"https://t.me/{(await bot.me()).username}?start=ref_{m.from_user.id}"
-    async with aiosqlite.connect(DB_PATH) as con:
+    link = f"https://t.me/{BOT_USERNAME}?start=ref_{m.from_user.id}"
+    async with POOL.read() as con:
         cur = await con.execute(
             "SELECT COUNT(1) FROM referrals WHERE referrer=? AND valid=1",
             (m.from_user.id,)
@@ -380,26 +687,20 @@ async def refer(m: Message):
 
 @dp.message(F.text == "👤 Profile")
 async def profile(m: Message):
-    async with aiosqlite.connect(DB_PATH) as con:
-        cur = await con.execute("SELECT upi, balance_cents, total_won_cents, last_win_round FROM users WHERE user_id=?", (m.from_user.id,))
-        upi, bal, won, last_round = await cur.fetchone() if (await cur.fetchone()) else (None,0,0,None)
-    # The above fetchone was consumed; fix by requery
-    async with aiosqlite.connect(DB_PATH) as con:
-        cur = await con.execute("SELECT upi, balance_cents, total_won_cents, last_win_round FROM users WHERE user_id=?", (m.from_user.id,))
+    async with POOL.read() as con:
+        cur = await con.execute(
+            "SELECT u.upi, u.balance_cents, u.total_won_cents, u.last_win_round, "
+            "(SELECT COUNT(1) FROM tickets WHERE user_id=u.user_id) "
+            "FROM users u WHERE u.user_id=?",
+            (m.from_user.id,),
+        )
         row = await cur.fetchone()
-    upi = row[0] if row else None
-    bal = row[1] if row else 0
-    won = row[2] if row else 0
-    last_round = row[3] if row else None
-
-    async with aiosqlite.connect(DB_PATH) as con:
-        cur = await con.execute("SELECT COUNT(1) FROM tickets WHERE user_id=?", (m.from_user.id,))
-        (ticket_count,) = await cur.fetchone()
+    upi, bal, won, last_round, ticket_count = row if row else (None, 0, 0, None, 0)
     await m.answer(
         "<b>Your Profile</b>\n"
         f"UPI: <code>{upi or 'Not set'}</code>\n"
-        f"Balance: ₹{bal/100:.2f}\n"
-        f"Total Won: ₹{won/100:.2f}\n"
+        f"Balance: {fmt_inr(bal)}\n"
+        f"Total Won: {fmt_inr(won)}\n"
         f"Last Round Won: {last_round or '-'}\n"
         f"Total Tickets: {ticket_count}"
     )
@@ -411,7 +712,7 @@ async def join_channel(m: Message):
 
 @dp.message(F.text == "🏆 Earnings Leaderboard")
 async def earnings_leaderboard(m: Message):
-    async with aiosqlite.connect(DB_PATH) as con:
+    async with POOL.read() as con:
         cur = await con.execute(
             "SELECT user_id, total_won_cents FROM users WHERE total_won_cents>0 ORDER BY total_won_cents DESC LIMIT 10"
         )
@@ -421,14 +722,15 @@ async def earnings_leaderboard(m: Message):
         return
     lines = []
     for i, (uid, cents) in enumerate(rows, 1):
-        lines.append(f"{i}. <a href='tg://user?id={uid}'>User {uid}</a> – ₹{cents/100:.2f}")
+        lines.append(f"{i}. <a href='tg://user?id={uid}'>User {uid}</a> – {fmt_inr(cents)}")
     await m.answer("<b>Top 10 Earnings</b>\n" + "\n".join(lines))
 
 @dp.message(F.text == "👑 Refer Leader")
 async def refer_leader(m: Message):
-    async with aiosqlite.connect(DB_PATH) as con:
+    async with POOL.read() as con:
         cur = await con.execute(
-            "SELECT referrer, SUM(valid) as cnt FROM referrals GROUP BY referrer ORDER BY cnt DESC LIMIT 10"
+            "SELECT user_id, valid_referral_count FROM users WHERE valid_referral_count>0 "
+            "ORDER BY valid_referral_count DESC LIMIT 10"
         )
         rows = await cur.fetchall()
     if not rows:
@@ -441,11 +743,7 @@ async def refer_leader(m: Message):
 
 @dp.message(F.text == "💳 Change UPI")
 async def change_upi(m: Message, state: FSMContext):
-    async with aiosqlite.connect(DB_PATH) as con:
-        cur = await con.execute("SELECT upi FROM users WHERE user_id=?", (m.from_user.id,))
-        (upi,) = await cur.fetchone() if (await cur.fetchone()) else (None,)
-    # Fix double fetch
-    async with aiosqlite.connect(DB_PATH) as con:
+    async with POOL.read() as con:
         cur = await con.execute("SELECT upi FROM users WHERE user_id=?", (m.from_user.id,))
         row = await cur.fetchone()
     cur_upi = row[0] if row else None
@@ -456,24 +754,26 @@ async def change_upi(m: Message, state: FSMContext):
 async def capture_upi(m: Message, state: FSMContext):
     new_upi = (m.text or "").strip()
     # Basic validation
-    if not re.match(r"^[\w._-]+@[\w.-]+$", new_upi):
+    if not UPI_RE.match(new_upi):
         await m.answer("That doesn't look like a UPI ID. Try again (e.g., name@bank).")
         return
-    async with aiosqlite.connect(DB_PATH) as con:
+    async with POOL.write() as con, transaction(con):
         # enforce uniqueness across all time: if ever linked, don't allow reuse
         cur = await con.execute("SELECT user_id FROM users WHERE upi=?", (new_upi,))
         row = await cur.fetchone()
-        if row and row[0] != m.from_user.id:
-            await m.answer("This UPI is already linked to another account. Choose a different one.")
-            return
-        await con.execute("UPDATE users SET upi=? WHERE user_id=?", (new_upi, m.from_user.id))
-        await con.commit()
+        taken = bool(row) and row[0] != m.from_user.id
+        if not taken:
+            await con.execute("UPDATE users SET upi=? WHERE user_id=?", (new_upi, m.from_user.id))
+    # reply only once the write lock is released
+    if taken:
+        await m.answer("This UPI is already linked to another account. Choose a different one.")
+        return
     await state.clear()
     await m.answer("✅ UPI updated.")
 
 @dp.message(F.text == "💸 Withdraw")
 async def withdraw(m: Message):
-    async with aiosqlite.connect(DB_PATH) as con:
+    async with POOL.read() as con:
         cur = await con.execute("SELECT upi, balance_cents FROM users WHERE user_id=?", (m.from_user.id,))
         row = await cur.fetchone()
     if not row:
@@ -490,10 +790,57 @@ async def withdraw(m: Message):
     kb.button(text="✅ Confirm Withdraw", callback_data="wd:confirm")
     kb.button(text="❌ Cancel", callback_data="wd:cancel")
     kb.adjust(1)
-    await m.answer(f"Withdraw full balance?\nUPI: <code>{upi}</code>\nAmount: ₹{cents/100:.2f}", reply_markup=kb.as_markup())
+    await m.answer(f"Withdraw full balance?\nUPI: <code>{upi}</code>\nAmount: {fmt_inr(cents)}", reply_markup=kb.as_markup())
 
 @dp.callback_query(F.data.startswith("wd:"))
 async def wd_actions(cq: CallbackQuery):
     action = cq.data.split(":",1)[1]
-    async with aiosqlite.connect(DB_PATH) as con:
-        cur = await con.execute("SELECT upi, balance_cents FROM users WHERE user_id=
+    if action == "cancel":
+        await cq.message.edit_text("Withdrawal cancelled.")
+        await cq.answer()
+        return
+    async with POOL.write() as con, transaction(con):
+        cur = await con.execute("SELECT upi, balance_cents FROM users WHERE user_id=?", (cq.from_user.id,))
+        row = await cur.fetchone()
+        eligible = bool(row) and bool(row[0]) and row[1] >= 100
+        if eligible:
+            upi, cents = row
+            await con.execute(
+                "INSERT INTO withdrawals(user_id, amount_cents, upi, created_at) VALUES(?,?,?,?)",
+                (cq.from_user.id, cents, upi, int(time.time())),
+            )
+            await con.execute("UPDATE users SET balance_cents=0 WHERE user_id=?", (cq.from_user.id,))
+    # reply only once the write lock is released
+    if not eligible:
+        await cq.answer("Nothing to withdraw.", show_alert=True)
+        return
+    await cq.message.edit_text(f"✅ Withdrawal of {fmt_inr(cents)} to <code>{upi}</code> requested.")
+    if LOG_GROUP_ID:
+        await bot.send_message(
+            LOG_GROUP_ID,
+            f"💸 Withdrawal request: <a href='tg://user?id={cq.from_user.id}'>User {cq.from_user.id}</a> – "
+            f"{fmt_inr(cents)} to <code>{upi}</code>",
+        )
+    await cq.answer()
+
+
+# --------------- Lifecycle ---------------
+async def on_startup():
+    global BOT_USERNAME
+    BOT_USERNAME = (await bot.me()).username
+    await POOL.open()
+    await ensure_db()
+    await load_current_round()
+    await get_settings()
+
+async def on_shutdown():
+    await POOL.close()
+
+async def main():
+    dp.startup.register(on_startup)
+    dp.shutdown.register(on_shutdown)
+    await dp.start_polling(bot)
+
+
+if __name__ == "__main__":
+    asyncio.run(main())